@@ -4,7 +4,18 @@ import zipfile
 import io
 import json
 import base64
-from openai import OpenAI
+import hashlib
+import re
+import time
+import httpx
+from openai import (
+    OpenAI,
+    APIError,
+    APITimeoutError,
+    APIConnectionError,
+    InternalServerError,
+    RateLimitError,
+)
 from docx import Document
 
 # ---------------------------------------------------------
@@ -272,6 +283,11 @@ def build_data_payload():
     return data
 
 
+def serialize_data_payload(data_payload: dict) -> str:
+    """Serialiserer payloaden til prompten – klippet ned for at undgå alt for lange prompts."""
+    return json.dumps(data_payload, default=str)[:20000]
+
+
 # ---------------------------------------------------------
 # DOCX-helper: Byg DOCX fra markdown-lignende AI-output
 # ---------------------------------------------------------
@@ -328,6 +344,122 @@ def build_docx_from_markdown(ai_output: str, customer_name: str = None, customer
     buffer.seek(0)
     return buffer
 
+# ---------------------------------------------------------
+# Checkpoints: gem færdige "### "-sektioner undervejs i streamingen
+# ---------------------------------------------------------
+# Antal automatiske genoptagelser, hvis streamingen fejler midt i rapporten
+MAX_STREAM_RESUMES = 2
+
+SECTION_HEADING_RE = re.compile(r"^### ", re.MULTILINE)
+
+
+class StreamInterruptedError(Exception):
+    """Streamingen blev afbrudt via et error-/failed-/incomplete-event fra Responses API."""
+
+    def __init__(self, message: str, resumable: bool = True):
+        super().__init__(message)
+        self.resumable = resumable
+
+
+# response.failed-fejlkoder, der skyldes serveren og derfor kan genoptages
+RESUMABLE_RESPONSE_ERROR_CODES = ("server_error", "rate_limit_exceeded")
+
+
+# Kun forbigående fejl genoptages automatisk – alt andet går direkte til fejlvisning.
+# httpx-fejlene dækker netværksfejl, når selve svaret læses under streamingen.
+RESUMABLE_STREAM_ERRORS = (
+    APITimeoutError,
+    APIConnectionError,
+    InternalServerError,
+    RateLimitError,
+    StreamInterruptedError,
+    httpx.TimeoutException,
+    httpx.TransportError,
+)
+
+# Ventetid (sekunder) før nyt forsøg ved RateLimitError uden retry-after – ganges med forsøgsnummeret
+RATE_LIMIT_BACKOFF_SECONDS = 5
+
+
+def is_resumable_stream_error(error: Exception) -> bool:
+    """Afgør om en fejl fra streamingen kan genoptages automatisk fra sidste checkpoint."""
+    # Opbrugt kvote er permanent – et nyt forsøg giver samme 429
+    if isinstance(error, RateLimitError) and getattr(error, "code", None) == "insufficient_quota":
+        return False
+    if isinstance(error, StreamInterruptedError):
+        return error.resumable
+    return isinstance(error, RESUMABLE_STREAM_ERRORS)
+
+
+def rate_limit_wait_seconds(error: RateLimitError, attempt: int) -> float:
+    """Ventetid før nyt forsøg: retry-after fra API'et, ellers fast backoff pr. forsøg."""
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    try:
+        return max(float(headers.get("retry-after")), 0.0)
+    except (TypeError, ValueError):
+        return RATE_LIMIT_BACKOFF_SECONDS * (attempt + 1)
+
+
+def split_completed_sections(text: str) -> list:
+    """Returnerer de sektioner, der med sikkerhed er færdigskrevne.
+
+    En sektion regnes først som færdig, når næste "### "-overskrift er begyndt,
+    så den sidste (igangværende) sektion er aldrig med.
+    """
+    starts = [m.start() for m in SECTION_HEADING_RE.finditer(text)]
+    return [text[start:end] for start, end in zip(starts, starts[1:])]
+
+
+def build_run_fingerprint(
+    model: str,
+    customer_name: str,
+    customer_url: str,
+    selected_slides: list,
+    extra_slides_text: str,
+    slide_notes: dict,
+    slide_images: dict,
+    serialized_data: str,
+) -> str:
+    """Fingeraftryk af input, så et checkpoint kun genbruges til samme analyse."""
+    image_hashes = {}
+    for slide, img in (slide_images or {}).items():
+        image_hashes[slide] = hashlib.sha256(img.getvalue()).hexdigest() if img is not None else None
+    raw = json.dumps(
+        [
+            model,
+            customer_name,
+            customer_url,
+            selected_slides,
+            extra_slides_text,
+            slide_notes,
+            image_hashes,
+            serialized_data,
+        ],
+        ensure_ascii=False,
+        default=str,
+    )
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def build_current_run_fingerprint(data_payload: dict) -> str:
+    """Fingeraftryk af de input, der aktuelt står i formularen."""
+    return build_run_fingerprint(
+        model=selected_model,
+        customer_name=customer_name,
+        customer_url=customer_url,
+        selected_slides=selected_slides,
+        extra_slides_text=extra_slides_text,
+        slide_notes=slide_notes,
+        slide_images=slide_images,
+        serialized_data=serialize_data_payload(data_payload),
+    )
+
+
+def reset_generation_checkpoint():
+    """Kasserer gemte sektioner, så næste kørsel starter fra første slide."""
+    st.session_state.pop("generation_checkpoint", None)
+
 # ---------------------------------------------------------
 # OpenAI-klient
 # ---------------------------------------------------------
@@ -438,7 +570,7 @@ def ask_ai(
     data_payload: dict,
 ):
     # Vi klipper payload ned for at undgå alt for lange prompts
-    serialized_data = json.dumps(data_payload, default=str)[:20000]
+    serialized_data = serialize_data_payload(data_payload)
     slide_notes_text = ""
     if slide_notes:
         lines = []
@@ -526,9 +658,14 @@ def ask_ai_stream(
     slide_notes: dict,
     slide_images: dict,
     data_payload: dict,
+    completed_sections: list | None = None,
 ):
-    """Streaming-version af AI-kaldet – yield'er tekststumper løbende."""
-    serialized_data = json.dumps(data_payload, default=str)[:20000]
+    """Streaming-version af AI-kaldet – yield'er tekststumper løbende.
+
+    Hvis `completed_sections` er angivet, sendes de færdige sektioner med som
+    kontekst, og modellen fortsætter fra første ufærdige slide.
+    """
+    serialized_data = serialize_data_payload(data_payload)
     slide_notes_text = ""
     if slide_notes:
         lines = []
@@ -580,6 +717,22 @@ def ask_ai_stream(
             except Exception:
                 continue
 
+    # Genoptagelse: send de allerede færdige sektioner med som kontekst
+    if completed_sections:
+        done_text = "".join(completed_sections).strip()
+        last_heading = completed_sections[-1].splitlines()[0][4:].strip()
+        content.append(
+            {
+                "type": "input_text",
+                "text": (
+                    "Følgende sektioner er allerede færdigskrevet og må IKKE gentages:\n\n"
+                    f"{done_text}\n\n"
+                    f"Fortsæt med den næste slide-overskrift efter \"{last_heading}\" og skriv resten af analysen "
+                    "efter samme krav. Start direkte med \"### \" og den næste overskrift – uden indledning."
+                ),
+            }
+        )
+
     with client.responses.stream(
         model=selected_model,
         input=[
@@ -589,16 +742,47 @@ def ask_ai_stream(
             }
         ],
     ) as stream:
-        for event in stream:
-            try:
-                # Responses streaming events: vi går efter output_text.delta events
-                if hasattr(event, "type") and event.type == "response.output_text.delta":
-                    delta_text = getattr(event, "delta", None)
-                    if delta_text:
-                        yield str(delta_text)
-            except Exception:
-                # Ignorer events vi ikke kan parse – fortsæt streaming
-                continue
+        try:
+            for event in stream:
+                event_type = getattr(event, "type", None)
+
+                # Fejl midt i streamingen kommer som events – ikke som exceptions
+                if event_type == "error":
+                    raise StreamInterruptedError(getattr(event, "message", None) or "Ukendt fejl i streamingen")
+                if event_type == "response.failed":
+                    # Kun serverfejl genoptages – fx et ugyldigt billede fejler igen
+                    error = getattr(getattr(event, "response", None), "error", None)
+                    code = getattr(error, "code", None)
+                    raise StreamInterruptedError(
+                        f"{event_type}: {getattr(error, 'message', None) or code or 'ingen detaljer'}",
+                        resumable=code in RESUMABLE_RESPONSE_ERROR_CODES,
+                    )
+                if event_type == "response.incomplete":
+                    # max_output_tokens kan fortsættes; fx content_filter giver samme resultat igen
+                    details = getattr(getattr(event, "response", None), "incomplete_details", None)
+                    reason = getattr(details, "reason", None)
+                    raise StreamInterruptedError(
+                        f"{event_type}: {reason or 'ingen detaljer'}",
+                        resumable=reason == "max_output_tokens",
+                    )
+
+                try:
+                    # Responses streaming events: vi går efter output_text.delta events
+                    if event_type == "response.output_text.delta":
+                        delta_text = getattr(event, "delta", None)
+                        if delta_text:
+                            yield str(delta_text)
+                except Exception:
+                    # Ignorer events vi ikke kan parse – fortsæt streaming
+                    continue
+        except (httpx.TimeoutException, httpx.TransportError) as e:
+            # Netværksfejl mens svaret læses (fx ReadTimeout, RemoteProtocolError)
+            raise StreamInterruptedError(f"Forbindelsen blev afbrudt under streamingen: {e}") from e
+        except APIError as e:
+            # Fejl-payloads i selve streamen kommer som APIError uden HTTP-statuskode
+            if getattr(e, "status_code", None) is not None:
+                raise
+            raise StreamInterruptedError(f"Fejl under streamingen: {e}") from e
 
 # ---------------------------------------------------------
 # Kør analyse (med streaming)
@@ -608,6 +792,7 @@ st.subheader("4. Kør analyse")
 run_analysis = st.button("Kør analyse")
 
 ai_output = None
+run_fingerprint = None
 
 if run_analysis:
     # Minimal validering – vi kræver som minimum Ahrefs-data
@@ -616,35 +801,104 @@ if run_analysis:
     else:
         data_payload = build_data_payload()
 
+        # Genbrug checkpoint fra en tidligere fejlet kørsel, hvis input er uændret
+        fingerprint = build_current_run_fingerprint(data_payload)
+        run_fingerprint = fingerprint
+        checkpoint = st.session_state.get("generation_checkpoint")
+        if not checkpoint or checkpoint.get("fingerprint") != fingerprint:
+            checkpoint = {"fingerprint": fingerprint, "sections": []}
+            st.session_state["generation_checkpoint"] = checkpoint
+
         placeholder = st.empty()
         status = st.empty()
-        status.write("Analyserer data med AI (streaming)...")
 
         full_text = ""
+        last_error = None
 
-        try:
-            for chunk in ask_ai_stream(
-                department=department,
-                customer_name=customer_name,
-                customer_url=customer_url,
-                selected_slides=selected_slides,
-                extra_slides_text=extra_slides_text,
-                slide_notes=slide_notes,
-                slide_images=slide_images,
-                data_payload=data_payload,
-            ):
-                full_text += chunk
-                placeholder.markdown("### Resultat\n\n" + full_text)
-        except Exception as e:
-            status.empty()
-            st.error(f"Der opstod en fejl i AI-streamingen: {e}")
-        else:
-            status.empty()
-            if full_text.strip():
-                st.success("Analyse gennemført.")
-                ai_output = full_text
+        for attempt in range(MAX_STREAM_RESUMES + 1):
+            completed_sections = list(checkpoint["sections"])
+            if completed_sections:
+                status.write(
+                    f"Fortsætter analysen efter {len(completed_sections)} færdige sektioner (streaming)..."
+                )
+            else:
+                status.write("Analyserer data med AI (streaming)...")
+
+            prefix = "".join(completed_sections)
+            full_text = prefix
+            new_text = ""
+
+            try:
+                for chunk in ask_ai_stream(
+                    department=department,
+                    customer_name=customer_name,
+                    customer_url=customer_url,
+                    selected_slides=selected_slides,
+                    extra_slides_text=extra_slides_text,
+                    slide_notes=slide_notes,
+                    slide_images=slide_images,
+                    data_payload=data_payload,
+                    completed_sections=completed_sections,
+                ):
+                    new_text += chunk
+                    full_text = prefix + new_text
+                    placeholder.markdown("### Resultat\n\n" + full_text)
+
+                    # Checkpoint hver gang en ny "### "-sektion er afsluttet
+                    sections = split_completed_sections(full_text)
+                    if len(sections) > len(checkpoint["sections"]):
+                        checkpoint["sections"] = sections
+            except Exception as e:
+                last_error = e
+                if not is_resumable_stream_error(e):
+                    break
+                if attempt < MAX_STREAM_RESUMES:
+                    st.warning(
+                        f"Forsøg {attempt + 1} af {MAX_STREAM_RESUMES + 1} fejlede: {e}. "
+                        "Prøver igen fra første ufærdige slide..."
+                    )
+                    if isinstance(e, RateLimitError):
+                        time.sleep(rate_limit_wait_seconds(e, attempt))
+                continue
             else:
-                st.error("Der opstod en fejl i AI-svaret. Prøv igen.")
+                last_error = None
+                break
+
+        status.empty()
+        if last_error is not None:
+            st.error(f"Der opstod en fejl i AI-streamingen: {last_error}")
+        elif full_text.strip():
+            st.success("Analyse gennemført.")
+            ai_output = full_text
+            st.session_state.pop("generation_checkpoint", None)
+        else:
+            st.error("Der opstod en fejl i AI-svaret. Prøv igen.")
+
+# ---------------------------------------------------------
+# Gemt checkpoint fra en afbrudt kørsel – genoptag eller start forfra
+# ---------------------------------------------------------
+saved_checkpoint = st.session_state.get("generation_checkpoint") or {}
+if saved_checkpoint.get("sections"):
+    # Genbrug fingeraftrykket fra denne kørsel – uploadede filer er allerede læst
+    current_fingerprint = run_fingerprint or build_current_run_fingerprint(build_data_payload())
+    col_info, col_reset = st.columns([3, 1])
+    with col_info:
+        if saved_checkpoint.get("fingerprint") == current_fingerprint:
+            st.info(
+                f"{len(saved_checkpoint['sections'])} færdige sektioner fra en afbrudt kørsel er gemt. "
+                "Klik på \"Kør analyse\" igen for at fortsætte fra første ufærdige slide."
+            )
+        else:
+            st.info(
+                f"{len(saved_checkpoint['sections'])} gemte sektioner fra en afbrudt kørsel hører til andre input "
+                "(filer, noter, model eller billeder er ændret). Næste kørsel starter forfra."
+            )
+    with col_reset:
+        st.button(
+            "Start forfra",
+            help="Kassér de gemte sektioner, så næste kørsel starter fra første slide.",
+            on_click=reset_generation_checkpoint,
+        )
 
 # ---------------------------------------------------------
 # DOCX-download